@@ -6,10 +6,15 @@
 # • Suporta consolidar várias empresas na mesma sessão (guarda no session_state).
 # ---------------------------------------------------------------
 
+import hashlib
+import importlib.util
 import io
+import itertools
 import math
+import string
 import time
 import zipfile
+import uuid
 from datetime import datetime
 
 import numpy as np
@@ -45,6 +50,9 @@ st.markdown(
     unsafe_allow_html=True,
 )
 
+# Leitor de .xlsx: python-calamine (Rust) quando instalado, senão openpyxl
+EXCEL_ENGINE = "calamine" if importlib.util.find_spec("python_calamine") else "openpyxl"
+
 # --------------------------
 # Regras de negócio (idênticas à macro)
 # --------------------------
@@ -69,63 +77,87 @@ ALERTA_PESO = {
     "Sem custo": 0,
 }
 
+# Colunas de ação/alerta como Categorical (conjunto pequeno e conhecido de valores)
+ACAO_DTYPE = pd.CategoricalDtype(list(ACAO_PESO.keys()))
+ALERTA_DTYPE = pd.CategoricalDtype(list(ALERTA_PESO.keys()))
+
+# Lookups vetorizados dos pesos (Series.map)
+ACAO_PESO_S = pd.Series(ACAO_PESO)
+ALERTA_PESO_S = pd.Series(ALERTA_PESO)
+
 # --------------------------
 # Utilitários
 # --------------------------
 
-def to_int(x):
-    try:
-        if pd.isna(x):
-            return 0
-        if isinstance(x, str):
-            # Lida com o formato de número brasileiro (ponto como milhar, vírgula como decimal)
-            x = str(x).strip().replace(".", "").replace(",", ".")
-            if x == "":
-                return 0
-            return int(float(x))
-        return int(float(x))
-    except Exception:
-        return 0
-
-
-def to_float(x):
-    try:
-        if pd.isna(x):
-            return 0.0
-        if isinstance(x, str):
-            # Lida com o formato de número brasileiro (ponto como milhar, vírgula como decimal)
-            x = str(x).strip().replace(".", "").replace(",", ".")
-            if x == "":
-                return 0.0
-            return float(x)
-        return float(x)
-    except Exception:
-        return 0.0
-
-
-def normalize_str(x):
-    if pd.isna(x):
-        return ""
-    return str(x).strip()
-
-
-def color_alert(val):
-    base = str(val).strip()
-    if base == "Alerta Vermelho":
-        return "background-color: #FFC7CE; color: #7a0613;"
-    if base == "Avaliar giro":
-        return "background-color: #FFEB9C; color: #5a4b00;"
-    if base == "Sem urgência":
-        return "background-color: #C6EFCE; color: #1e6b3a;"
-    if base == "Sem custo":
-        return "background-color: #F2F2F2; color: #333;"
-    return ""
+# Número brasileiro -> formato Python: remove ponto de milhar e troca vírgula por ponto
+_BR_NUM_TRANS = str.maketrans({".": "", ",": "."})
+
+
+def clean_numeric(s: pd.Series, as_int=False) -> pd.Series:
+    """Converte uma coluna para número de forma vetorizada (0 quando vazio/inválido)."""
+    tipo = pd.api.types.infer_dtype(s, skipna=True)
+    if tipo in ("integer", "floating", "mixed-integer-float", "decimal", "boolean", "empty"):
+        out = pd.to_numeric(s, errors="coerce")
+    else:
+        # Textos no formato de número brasileiro (ponto como milhar, vírgula como decimal)
+        e_txt = s.notna() if tipo == "string" else s.map(lambda v: isinstance(v, str)).astype(bool)
+        txt = s[e_txt].astype(str).str.strip().str.translate(_BR_NUM_TRANS)
+        out = pd.to_numeric(txt, errors="coerce").reindex(s.index)
+        if tipo != "string":
+            # Demais células: só int/float/bool contam como número; datas (o Excel converte
+            # "3/4" em data) viram NaN -> 0, como nos antigos to_int/to_float
+            e_num = s.map(lambda v: isinstance(v, (int, float, np.number, np.bool_))).astype(bool)
+            out = out.fillna(pd.to_numeric(s.astype(object).where(e_num), errors="coerce"))
+    # inf/-inf (ex.: texto "inf") contam como inválidos, como nos antigos to_int/to_float
+    out = out.where(np.isfinite(out)).fillna(0)
+    # Valores em R$ ficam em float64 para não perder centavos.
+    if not as_int:
+        return out.astype(np.float64)
+    # Inteiros (quantidades) em int32 quando cabem; se algum valor estoura o int32
+    # (ex.: código de barras digitado na coluna), a coluna fica em int64.
+    # Somas entre empresas são feitas em int64.
+    out = out.astype(np.int64)
+    i32 = np.iinfo(np.int32)
+    if out.empty or (out.min() >= i32.min and out.max() <= i32.max):
+        return out.astype(np.int32)
+    return out
+
+
+ALERTA_CORES = {
+    "Alerta Vermelho": "background-color: #FFC7CE; color: #7a0613;",
+    "Avaliar giro": "background-color: #FFEB9C; color: #5a4b00;",
+    "Sem urgência": "background-color: #C6EFCE; color: #1e6b3a;",
+    "Sem custo": "background-color: #F2F2F2; color: #333;",
+}
+
+
+def color_alert(s: pd.Series):
+    # Usado com Styler.apply: uma chamada por coluna (não por célula)
+    arr = np.full(len(s), "", dtype=object)
+    for alerta, estilo in ALERTA_CORES.items():
+        arr[s.eq(alerta).to_numpy(dtype=bool, na_value=False)] = estilo
+    return arr
 
 
 def human_int(n):
     return f"{int(n):,}".replace(",", ".")
 
 
+def human_brl(v):
+    return f"R$ {float(v):,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+
+
+def agregados_empresa(df_emp: pd.DataFrame) -> dict:
+    # Totais dos KPIs da aba Empresa, calculados uma vez ao processar
+    return {
+        "skus": len(df_emp),
+        "vendas30": int(df_emp["Vendas últimos 30 dias"].sum()),
+        "estoque": int(df_emp["Estoque Full"].sum()),
+        "custo": float(df_emp["Custo total"].fillna(0).sum()),
+        "alertas": {k: int(v) for k, v in df_emp["Alerta de custo"].value_counts().items()},
+    }
+
+
 # --------------------------
 # Parsing do Relatório FULL (aba "Resumo") — colunas equivalentes à macro
 # --------------------------
@@ -153,98 +185,124 @@ FULL_MAP = {
 }
 
 
-def excel_letter_to_index(letter: str) -> int:
-    # 1-based
-    letter = letter.upper().strip()
-    result = 0
-    for ch in letter:
-        result = result * 26 + (ord(ch) - 64)
-    return result
+# Letra da coluna do Excel -> índice 0-based ("A" = 0 ... "ZZ" = 701)
+COLNAME_TO_IDX = {
+    letter: idx
+    for idx, letter in enumerate(itertools.chain(
+        string.ascii_uppercase,
+        (a + b for a in string.ascii_uppercase for b in string.ascii_uppercase),
+    ))
+}
+
+FULL_MAP_IDX = {name: COLNAME_TO_IDX[col] for name, col in FULL_MAP.items()}
+
+# Colunas inteiras do Resumo (convertidas uma única vez, na leitura)
+FULL_INT_COLS = [
+    "Vendas últimos 30 dias",
+    "Aptas venda",
+    "Não aptas",
+    "Estoque Full",
+    "Boa Qualidade",
+    "Qtd. Impulsionar",
+    "Qtd. Corrigir",
+    "Qtd. Risco Descarte",
+]
+
+
+def _ler_colunas(xls, sheet, start_row, idx_map: dict, text_cols):
+    # Lê só as colunas mapeadas a partir de start_row. usecols como função (e não lista)
+    # para não falhar quando a aba não tem essas colunas (ex.: só cabeçalho) —
+    # colunas ausentes voltam vazias.
+    idxs = list(idx_map.values())
+    df = pd.read_excel(
+        xls,
+        sheet_name=sheet,
+        engine=EXCEL_ENGINE,
+        header=None,
+        skiprows=start_row,
+        usecols=lambda i: i in idxs,
+        dtype={idx_map[c]: "string[pyarrow]" for c in text_cols},
+    )
+    df = df.reindex(columns=idxs)
+    df.columns = list(idx_map.keys())
+    return df.astype({c: "string[pyarrow]" for c in text_cols})
 
 
 def read_full_resumo(xls, start_row=12):
     """Lê a planilha 'Resumo' do arquivo FULL e retorna DataFrame com colunas já mapeadas."""
-    df = pd.read_excel(xls, sheet_name="Resumo", header=None)
-    out = {}
-    for name, col in FULL_MAP.items():
-        idx = excel_letter_to_index(col) - 1
-        out[name] = df.iloc[:, idx]
-    tmp = pd.DataFrame(out)
-    # manter a partir da linha 13 da planilha (índice 12 zero-based)
-    tmp = tmp.iloc[start_row:, :].copy()
+    # a partir da linha 13 da planilha (índice 12 zero-based)
+    tmp = _ler_colunas(
+        xls, "Resumo", start_row, FULL_MAP_IDX, ("SKU", "# Anúncio", "Produto", "Status", "Tempo até esgotar")
+    )
     # limpeza básica
-    for c in [
-        "Vendas últimos 30 dias",
-        "Aptas venda",
-        "Não aptas",
-        "Estoque Full",
-        "Boa Qualidade",
-        "Qtd. Impulsionar",
-        "Qtd. Corrigir",
-        "Qtd. Risco Descarte",
-    ]:
-        tmp[c] = tmp[c].map(to_int)
-    tmp["Tempo até esgotar"] = tmp["Tempo até esgotar"].map(normalize_str)
-    tmp["Status"] = tmp["Status"].map(lambda x: normalize_str(x).lower())
-    tmp["SKU"] = tmp["SKU"].map(normalize_str)
-    tmp["Produto"] = tmp["Produto"].map(normalize_str)
+    for c in FULL_INT_COLS:
+        tmp[c] = clean_numeric(tmp[c], as_int=True)
+    for c in ("SKU", "Produto", "Tempo até esgotar"):
+        tmp[c] = tmp[c].str.strip().fillna("")
+    tmp["Status"] = tmp["Status"].str.strip().str.lower().fillna("")
     return tmp
 
 
+@st.cache_data(max_entries=8, ttl="1h", show_spinner=False)
+def _read_full_resumo_cached(file_bytes: bytes, start_row=12):
+    # Cache pelo conteúdo do arquivo (bytes), não pelo objeto do upload
+    return read_full_resumo(io.BytesIO(file_bytes), start_row=start_row)
+
+
 # --------------------------
 # Regras de filtro e sugestão (iguais à macro)
 # --------------------------
 
 def filtrar_e_sugerir(df):
-    rows = []
-    for _, r in df.iterrows():
-        status = (r.get("Status", "") or "").strip().lower()
-        estoque_full = int(r.get("Estoque Full", 0))
-        vendas = int(r.get("Vendas últimos 30 dias", 0))
-
-        # A NOVA LÓGICA DE FILTRO:
-        # Se houve VENDAS > 0, ou o status é "ativo" ou "n/a" com estoque, inclua.
-        # Isso garante que todos os SKUs que tiveram algum giro recente sejam incluídos.
-        if vendas > 0 or status == "ativo" or (status == "n/a" and estoque_full > 0):
-            qtd_mon = int(r.get("Boa Qualidade", 0))
-            qtd_imp = int(r.get("Qtd. Impulsionar", 0))
-            qtd_cor = int(r.get("Qtd. Corrigir", 0))
-            qtd_desc = int(r.get("Qtd. Risco Descarte", 0))
-
-            # A lógica de sugestão permanece a mesma, pois é ela que classifica a ação.
-            if vendas == 0 and qtd_desc > 0:
-                sugestao = "Avaliar retirada / sem reposição"
-            elif estoque_full < 5 and vendas >= 10:
-                sugestao = "Repor imediatamente"
-            elif qtd_imp > 100:
-                sugestao = "Campanha de giro agressiva"
-            elif qtd_imp > 0 and vendas >= 3:
-                sugestao = "Campanha de giro / reduzir estoque"
-            elif qtd_cor > 0 and vendas > 5:
-                sugestao = "Corrigir anúncio e repor"
-            elif vendas < 5 and estoque_full > 10:
-                sugestao = "Evitar reposição / criar promoção"
-            else:
-                sugestao = "Sem ação definida"
-
-            rows.append({
-                "SKU": r.get("SKU"),
-                "# Anúncio": r.get("# Anúncio"),
-                "Produto": r.get("Produto"),
-                "Vendas últimos 30 dias": vendas,
-                "Afeta métrica estoque": r.get("Afeta métrica estoque"),
-                "Entrada pendente": r.get("Entrada pendente"),
-                "Unid. aptas p/ venda": int(r.get("Aptas venda", 0)),
-                "Não aptas": int(r.get("Não aptas", 0)),
-                "Estoque Full": estoque_full,
-                "Boa Qualidade": qtd_mon,
-                "Qtd. Impulsionar": qtd_imp,
-                "Qtd. Corrigir": qtd_cor,
-                "Qtd. Risco Descarte": qtd_desc,
-                "Tempo até esgotar": r.get("Tempo até esgotar"),
-                "Comentário estoque": sugestao,
-            })
-    return pd.DataFrame(rows)
+    # Filtro e sugestão calculados por coluna (sem iterar linha a linha)
+    # read_full_resumo já entrega as colunas inteiras (int32, ou int64 se não couberem)
+    # e o Status normalizado; aqui só se garante um dtype inteiro, sem reduzir largura
+    df = df.astype({c: np.int64 for c in FULL_INT_COLS if not pd.api.types.is_integer_dtype(df[c])})
+
+    status = df["Status"]
+    estoque_full = df["Estoque Full"]
+    vendas = df["Vendas últimos 30 dias"]
+
+    # A NOVA LÓGICA DE FILTRO:
+    # Se houve VENDAS > 0, ou o status é "ativo" ou "n/a" com estoque, inclua.
+    # Isso garante que todos os SKUs que tiveram algum giro recente sejam incluídos.
+    keep = (vendas > 0) | (status == "ativo") | ((status == "n/a") & (estoque_full > 0))
+    df = df.loc[keep].reset_index(drop=True)
+
+    vendas = df["Vendas últimos 30 dias"].to_numpy()
+    estoque_full = df["Estoque Full"].to_numpy()
+    qtd_imp = df["Qtd. Impulsionar"].to_numpy()
+    qtd_cor = df["Qtd. Corrigir"].to_numpy()
+    qtd_desc = df["Qtd. Risco Descarte"].to_numpy()
+
+    # A lógica de sugestão permanece a mesma, pois é ela que classifica a ação.
+    # (np.select respeita a ordem: vale a primeira condição verdadeira, como no if/elif)
+    condicoes = [
+        (vendas == 0) & (qtd_desc > 0),
+        (estoque_full < 5) & (vendas >= 10),
+        qtd_imp > 100,
+        (qtd_imp > 0) & (vendas >= 3),
+        (qtd_cor > 0) & (vendas > 5),
+        (vendas < 5) & (estoque_full > 10),
+    ]
+    sugestoes = [
+        "Avaliar retirada / sem reposição",
+        "Repor imediatamente",
+        "Campanha de giro agressiva",
+        "Campanha de giro / reduzir estoque",
+        "Corrigir anúncio e repor",
+        "Evitar reposição / criar promoção",
+    ]
+
+    out = df[[
+        "SKU", "# Anúncio", "Produto", "Vendas últimos 30 dias", "Afeta métrica estoque",
+        "Entrada pendente", "Aptas venda", "Não aptas", "Estoque Full", "Boa Qualidade",
+        "Qtd. Impulsionar", "Qtd. Corrigir", "Qtd. Risco Descarte", "Tempo até esgotar",
+    ]].rename(columns={"Aptas venda": "Unid. aptas p/ venda"})
+    out["Comentário estoque"] = pd.Categorical(
+        np.select(condicoes, sugestoes, default="Sem ação definida"), dtype=ACAO_DTYPE
+    )
+    return out
 
 # --------------------------
 # Custos (sheet: "Custos por estoque antigo")
@@ -257,21 +315,19 @@ CUSTOS_MAP = {
     "Custo total": "K",
     "Unid. aptas p/ venda (custo)": "L",
 }
+CUSTOS_MAP_IDX = {name: COLNAME_TO_IDX[col] for name, col in CUSTOS_MAP.items()}
 
 
 def read_custos(xls, sheet="Custos por estoque antigo", start_row=2):
-    df = pd.read_excel(xls, sheet_name=sheet, header=None)
-    out = {}
-    for name, col in CUSTOS_MAP.items():
-        idx = excel_letter_to_index(col) - 1
-        out[name] = df.iloc[:, idx]
-    tmp = pd.DataFrame(out)
-    tmp = tmp.iloc[start_row:, :].copy()
-    tmp["SKU"] = tmp["SKU"].map(normalize_str)
-    for c in ["Estoque com custo antigo", "Unid. aptas p/ venda (custo)"]:
-        tmp[c] = tmp[c].map(to_float)
-    for c in ["Dias estocado (média) [sum]", "Custo total"]:
-        tmp[c] = tmp[c].map(to_float)
+    tmp = _ler_colunas(xls, sheet, start_row, CUSTOS_MAP_IDX, ("SKU",))
+    tmp["SKU"] = tmp["SKU"].str.strip().fillna("")
+    for c in [
+        "Estoque com custo antigo",
+        "Unid. aptas p/ venda (custo)",
+        "Dias estocado (média) [sum]",
+        "Custo total",
+    ]:
+        tmp[c] = clean_numeric(tmp[c])
     # agrega por SKU (soma e média de dias)
     agg = tmp.groupby("SKU").agg({
         "Estoque com custo antigo": "sum",
@@ -285,6 +341,11 @@ def read_custos(xls, sheet="Custos por estoque antigo", start_row=2):
     return agg.reset_index()[["SKU", "Estoque antigo", "Dias estocado (média)", "Custo total", "Aptas custo"]]
 
 
+@st.cache_data(max_entries=8, ttl="1h", show_spinner=False)
+def _read_custos_cached(file_bytes: bytes, sheet="Custos por estoque antigo", start_row=2):
+    return read_custos(io.BytesIO(file_bytes), sheet=sheet, start_row=start_row)
+
+
 def aplicar_custos(df_emp, df_custos):
     out = df_emp.merge(df_custos, on="SKU", how="left")
     out["Custo total"] = out["Custo total"].fillna(0).round(2)
@@ -304,7 +365,7 @@ def aplicar_custos(df_emp, df_custos):
         else:
             return "Sem urgência"
 
-    out["Alerta de custo"] = out["Custo total"].map(alerta)
+    out["Alerta de custo"] = out["Custo total"].map(alerta).astype(ALERTA_DTYPE)
     return out
 
 
@@ -312,135 +373,269 @@ def aplicar_custos(df_emp, df_custos):
 # Consolidado (junta várias empresas carregadas)
 # --------------------------
 
+def _peso(col: pd.Series, pesos: pd.Series) -> pd.Series:
+    # Valores fora do mapa (ou vazios) ficam com peso -1
+    return col.map(pesos).astype(np.float64).fillna(-1).astype(np.int8)
+
+
+def _maior_prioridade(all_df, col, col_peso, padrao, peso_padrao):
+    # Por SKU, fica o valor de maior peso (o primeiro em caso de empate), como na macro;
+    # se nenhum supera o peso do padrão, mantém o padrão.
+    idx = all_df.groupby("SKU", sort=False)[col_peso].idxmax()
+    vencedor = all_df.loc[idx, ["SKU", col, col_peso]].set_index("SKU")
+    return vencedor[col].where(vencedor[col_peso] > peso_padrao, padrao)
+
+
+def parcial_empresa(df: pd.DataFrame) -> pd.DataFrame:
+    # Contribuição de uma empresa ao consolidado, já reduzida a uma linha por SKU:
+    # somas, primeiro Produto e a ação/alerta de maior peso (com o peso).
+    # Calculada uma vez ao processar a empresa e guardada na sessão.
+    df = df[df["SKU"].notna() & (df["SKU"] != "")]
+    df = df.assign(
+        _acao_peso=_peso(df["Comentário estoque"], ACAO_PESO_S),
+        _alerta_peso=_peso(df["Alerta de custo"], ALERTA_PESO_S),
+    )
+    g = df.groupby("SKU", sort=False)
+    parcial = g.agg(
+        Produto=("Produto", "first"),
+        **{
+            "Vendas últimos 30 dias": ("Vendas últimos 30 dias", "sum"),
+            "Estoque Full": ("Estoque Full", "sum"),
+            "Custo total": ("Custo total", "sum"),
+        },
+    )
+    for col, col_peso in (("Comentário estoque", "_acao_peso"), ("Alerta de custo", "_alerta_peso")):
+        parcial[[col, col_peso]] = df.loc[g[col_peso].idxmax(), [col, col_peso]].set_axis(parcial.index)
+    return parcial.reset_index()
+
+
+def consolidar_parciais(parciais: dict):
+    # parciais: {empresa: parcial_empresa(df)}, na ordem de processamento.
+    # As mesmas reduções valem sobre as parciais (soma de somas, primeiro dos primeiros,
+    # maior peso dos maiores), então só as linhas por SKU de cada empresa são combinadas.
+    if not parciais:
+        return pd.DataFrame()
+    all_df = pd.concat([p.assign(Empresa=e) for e, p in parciais.items()], ignore_index=True)
+    if all_df.empty:
+        return pd.DataFrame()
+
+    # Agregados por SKU (na ordem em que aparecem)
+    agg = all_df.groupby("SKU", sort=False).agg(
+        Produto=("Produto", "first"),
+        **{"Custo Total": ("Custo total", "sum")},
+    )
+
+    # Vendas/Estoque por empresa: soma por (empresa, SKU) via np.add.at sobre os códigos
+    # de um Categorical (SKUs na mesma ordem de `agg`; empresa fora da lista = código -1)
+    sku_codes = pd.Categorical(all_df["SKU"], categories=agg.index).codes
+    emp_codes = pd.Categorical(all_df["Empresa"], categories=EMPRESAS).codes
+    ok = emp_codes >= 0
+    vendas = np.zeros((len(EMPRESAS), len(agg)), np.int64)
+    estoque = np.zeros((len(EMPRESAS), len(agg)), np.int64)
+    np.add.at(vendas, (emp_codes[ok], sku_codes[ok]), all_df["Vendas últimos 30 dias"].to_numpy(np.int64)[ok])
+    np.add.at(estoque, (emp_codes[ok], sku_codes[ok]), all_df["Estoque Full"].to_numpy(np.int64)[ok])
+
+    out = agg[["Produto"]].copy()
+    for i, e in enumerate(EMPRESAS):
+        out[f"Vendas {e}"] = vendas[i]
+        out[f"Estoque {e}"] = estoque[i]
+    out["Total Vendas 30d"] = vendas.sum(axis=0)
+    out["Total Estoque"] = estoque.sum(axis=0)
+    out["Custo Total"] = agg["Custo Total"]
+
+    # Empresas Envolvidas: um bit por empresa (na ordem de processamento) por SKU,
+    # decodificado uma vez por combinação distinta
+    ordem = list(parciais)
+    bits = np.zeros(len(agg), np.int64)
+    np.bitwise_or.at(bits, sku_codes, np.left_shift(1, pd.Categorical(all_df["Empresa"], categories=ordem).codes))
+    combos, inv = np.unique(bits, return_inverse=True)
+    nomes = np.array([", ".join(e for i, e in enumerate(ordem) if m >> i & 1) for m in combos], dtype=object)
+    out["Empresas Envolvidas"] = nomes[inv]
+
+    # Maior prioridade (pesos inteiros pré-calculados nas parciais, argmax por SKU)
+    out["Ação Recomendada"] = _maior_prioridade(
+        all_df, "Comentário estoque", "_acao_peso", "Sem ação definida", ACAO_PESO["Sem ação definida"]
+    )
+    out["Alerta de Custo"] = _maior_prioridade(
+        all_df, "Alerta de custo", "_alerta_peso", "Sem custo", ALERTA_PESO["Sem custo"]
+    )
+    out = out.reset_index()
+
+    # Margem % (placeholder — na macro: dados(16) = (Total Vendas * 1) / Custo_total)
+    out["Margem %"] = np.where(out["Custo Total"] > 0, (out["Total Vendas 30d"] * 1.0) / out["Custo Total"], 0.0)
+    return out
+
+
 def consolidar_empresas(objs: dict):
     # objs: {empresa: df_empresarial_com_custos}
-    # Prepara estrutura por SKU
-    buckets = {}
-    for emp, df in objs.items():
-        for _, r in df.iterrows():
-            sku = r["SKU"]
-            if not sku:
-                continue
-            b = buckets.get(sku, {
-                "SKU": sku,
-                "Produto": r.get("Produto", ""),
-                "Vendas VALE RACE": 0,
-                "Estoque VALE RACE": 0,
-                "Vendas VANPARTS": 0,
-                "Estoque VANPARTS": 0,
-                "Vendas MOTOILBR": 0,
-                "Estoque MOTOILBR": 0,
-                "Vendas LUB EXPRESS": 0,
-                "Estoque LUB EXPRESS": 0,
-                "Total Vendas 30d": 0,
-                "Total Estoque": 0,
-                "Custo Total": 0.0,
-                "Empresas Envolvidas": "",
-                "Ação Recomendada": "Sem ação definida",
-                "Alerta de Custo": "Sem custo",
-            })
-            vendas = int(r.get("Vendas últimos 30 dias", 0))
-            estoque = int(r.get("Estoque Full", 0))
-            custo = float(r.get("Custo total", 0.0))
-            acao = r.get("Comentário estoque", "Sem ação definida")
-            alerta = r.get("Alerta de custo", "Sem custo")
-
-            if emp == "VALE RACE":
-                b["Vendas VALE RACE"] += vendas
-                b["Estoque VALE RACE"] += estoque
-            elif emp == "VANPARTS":
-                b["Vendas VANPARTS"] += vendas
-                b["Estoque VANPARTS"] += estoque
-            elif emp == "MOTOILBR":
-                b["Vendas MOTOILBR"] += vendas
-                b["Estoque MOTOILBR"] += estoque
-            elif emp == "LUB EXPRESS":
-                b["Vendas LUB EXPRESS"] += vendas
-                b["Estoque LUB EXPRESS"] += estoque
-
-            b["Total Vendas 30d"] = (
-                b["Vendas VALE RACE"] + b["Vendas VANPARTS"] + b["Vendas MOTOILBR"] + b["Vendas LUB EXPRESS"]
-            )
-            b["Total Estoque"] = (
-                b["Estoque VALE RACE"] + b["Estoque VANPARTS"] + b["Estoque MOTOILBR"] + b["Estoque LUB EXPRESS"]
-            )
-            b["Custo Total"] += custo
+    return consolidar_parciais({e: parcial_empresa(d) for e, d in objs.items()})
 
-            if emp not in b["Empresas Envolvidas"]:
-                b["Empresas Envolvidas"] = (b["Empresas Envolvidas"] + ", " + emp).strip(", ")
 
-            # Maior prioridade
-            if ACAO_PESO.get(acao, -1) > ACAO_PESO.get(b["Ação Recomendada"], -1):
-                b["Ação Recomendada"] = acao
-            if ALERTA_PESO.get(alerta, -1) > ALERTA_PESO.get(b["Alerta de Custo"], -1):
-                b["Alerta de Custo"] = alerta
+@st.cache_data(max_entries=4, show_spinner=False)
+def _consolidar_cached(empresas: tuple, versoes: tuple, _parciais: tuple):
+    # Chave = empresas (na ordem de processamento) + versão de cada uma (gravada ao
+    # processar). As parciais não entram no hash: o Streamlit só amostra DataFrames
+    # grandes e não perceberia valores alterados com o mesmo formato.
+    return consolidar_parciais(dict(zip(empresas, _parciais)))
 
-            buckets[sku] = b
 
-    if not buckets:
-        return pd.DataFrame()
-    out = pd.DataFrame(list(buckets.values()))
+def _chave_sessao():
+    # (empresas, versões) das empresas carregadas, na ordem de processamento.
+    # Empresas sem parcial/versão (sessão criada antes delas) ganham as suas aqui.
+    dados = st.session_state.empresas_data
+    parciais = st.session_state.empresas_partial
+    versoes = st.session_state.empresas_versao
+    empresas = tuple(dados)
+    for e in empresas:
+        if e not in parciais:
+            parciais[e] = parcial_empresa(dados[e])
+        if e not in versoes:
+            versoes[e] = uuid.uuid4().hex
+    return empresas, tuple(versoes[e] for e in empresas)
 
-    # Margem % (placeholder — na macro: dados(16) = (Total Vendas * 1) / Custo_total)
-    out["Margem %"] = np.where(out["Custo Total"] > 0, (out["Total Vendas 30d"] * 1.0) / out["Custo Total"], 0.0)
-    return out
+
+def consolidado_da_sessao():
+    # Usa as parciais guardadas ao processar cada empresa (só a empresa
+    # reprocessada é recalculada; as demais são reaproveitadas).
+    empresas, versoes = _chave_sessao()
+    parciais = st.session_state.empresas_partial
+    return _consolidar_cached(empresas, versoes, tuple(parciais[e] for e in empresas))
 
 
 # --------------------------
 # Reposição (DBM) — mesma lógica da macro
 # --------------------------
 
+# Categorias por média diária: Alta (> 1), Média (>= 0,3), Baixa
+CATEGORIAS = np.array(["Alta", "Média", "Baixa"])
+FATORES = np.array([1.3, 1.2, 1.1])
+EXTRAS = np.array([2, 1, 0])
+
+
 def simular_reposicao(df_consol):
     if df_consol.empty:
         return df_consol
     df = df_consol.copy()
-    media_diaria = df["Total Vendas 30d"].astype(float) / 30.0
-
-    def classificar(md):
-        if md > 1:
-            return ("Alta", 1.3, 2)
-        elif md >= 0.3:
-            return ("Média", 1.2, 1)
-        return ("Baixa", 1.1, 0)
-
-    cats = media_diaria.map(classificar)
-    df["Categoria"] = cats.map(lambda x: x[0])
-    df["Fator"] = cats.map(lambda x: x[1])
-    df["Extra"] = cats.map(lambda x: x[2])
-    df["Qtd. Sugerida"] = (media_diaria * 15 * df["Fator"] + df["Extra"]).round(0).astype(int)
-
-    def crit(estoque, sug):
-        if estoque == 0:
-            return "Ruptura total"
-        if estoque < sug * 0.5:
-            return "Reposição urgente"
-        if estoque < sug:
-            return "Reposição recomendada"
-        return "OK"
-
-    df["Criticidade"] = [crit(e, s) for e, s in zip(df["Total Estoque"].astype(int), df["Qtd. Sugerida"].astype(int))]
-    df["Cálculo Usado"] = [
-        f"Média {md:.2f} × 15 × {f} + {ex} = {int(s)}" for md, f, ex, s in zip(media_diaria, df["Fator"], df["Extra"], df["Qtd. Sugerida"])
+    media_diaria = df["Total Vendas 30d"].to_numpy(np.float64) / 30.0
+
+    cat_idx = np.where(media_diaria > 1, 0, np.where(media_diaria >= 0.3, 1, 2))
+    fator = FATORES[cat_idx]
+    extra = EXTRAS[cat_idx]
+    sug = np.rint(media_diaria * 15 * fator + extra).astype(np.int64)
+    estoque = df["Total Estoque"].to_numpy().astype(np.int64)
+
+    df["Categoria"] = CATEGORIAS[cat_idx]
+    df["Qtd. Sugerida"] = sug
+    df["Criticidade"] = np.select(
+        [estoque == 0, estoque < sug * 0.5, estoque < sug],
+        ["Ruptura total", "Reposição urgente", "Reposição recomendada"],
+        default="OK",
+    )
+    # "Média {md:.2f} × 15 × {fator} + {extra} = {sug}", montado coluna a coluna com np.char
+    partes = [
+        np.char.mod("%.2f", media_diaria), " × 15 × ", np.char.mod("%g", fator),
+        " + ", extra.astype(str), " = ", sug.astype(str),
     ]
+    calculo = np.char.add("Média ", partes[0])
+    for parte in partes[1:]:
+        calculo = np.char.add(calculo, parte)
+    df["Cálculo Usado"] = calculo
     return df[[
         "SKU", "Produto", "Total Vendas 30d", "Total Estoque", "Qtd. Sugerida", "Criticidade", "Categoria", "Cálculo Usado"
     ]]
 
 
+@st.cache_data(max_entries=4, show_spinner=False)
+def _simular_reposicao_cached(empresas: tuple, versoes: tuple, _df_consol):
+    # Mesma chave do consolidado (o DataFrame não entra no hash; ver _consolidar_cached)
+    return simular_reposicao(_df_consol)
+
+
+def reposicao_da_sessao(df_con):
+    # df_con = consolidado_da_sessao()
+    empresas, versoes = _chave_sessao()
+    return _simular_reposicao_cached(empresas, versoes, df_con)
+
+
 # --------------------------
 # Export helpers
 # --------------------------
 
-def to_excel_bytes(dfs: dict):
+def to_excel_bytes(dfs: dict, chunk=10_000):
     # dfs: {sheet_name: df}
+    # xlsxwriter em modo constant_memory: cada linha é descarregada assim que escrita.
+    # Esse modo exige escrever linha a linha e em ordem — df.to_excel escreve por coluna
+    # (perderia dados), então as linhas são escritas aqui direto na planilha.
     bio = io.BytesIO()
-    with pd.ExcelWriter(bio, engine="xlsxwriter") as writer:
+    options = {"constant_memory": True, "strings_to_formulas": False, "strings_to_urls": False}
+    with pd.ExcelWriter(bio, engine="xlsxwriter", engine_kwargs={"options": options}) as writer:
+        header_fmt = writer.book.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
         for name, df in dfs.items():
-            df.to_excel(writer, sheet_name=name[:31], index=False)
+            ws = writer.book.add_worksheet(name[:31])
+            ws.write_row(0, 0, [str(c) for c in df.columns], header_fmt)
+            for ini in range(0, len(df), chunk):
+                bloco = df.iloc[ini:ini + chunk].astype(object)
+                bloco = bloco.where(bloco.notna(), None)  # vazios viram células em branco
+                for i, row in enumerate(bloco.itertuples(index=False), start=ini + 1):
+                    ws.write_row(i, 0, row)
     bio.seek(0)
     return bio.getvalue()
 
 
+# --------------------------
+# Exibição de tabelas
+# --------------------------
+# Acima deste limite a tabela é cortada (com opção de ver tudo, sem cores)
+MAX_LINHAS_TABELA = 5000
+
+
+def mostrar_tabela_alerta(df: pd.DataFrame, col_alerta: str, key: str):
+    if len(df) <= MAX_LINHAS_TABELA:
+        st.dataframe(df.style.apply(color_alert, subset=[col_alerta]), use_container_width=True, hide_index=True)
+        return
+    if st.checkbox(f"Mostrar todos ({human_int(len(df))} linhas, sem cores)", key=key):
+        st.dataframe(df, use_container_width=True, hide_index=True)
+    else:
+        st.caption(f"Mostrando as primeiras {human_int(MAX_LINHAS_TABELA)} de {human_int(len(df))} linhas.")
+        sty = df.head(MAX_LINHAS_TABELA).style.apply(color_alert, subset=[col_alerta])
+        st.dataframe(sty, use_container_width=True, hide_index=True)
+
+
+@st.fragment
+def _render_filtros_empresa(df_emp: pd.DataFrame):
+    # Filtros básicos
+    colf1, colf2, colf3 = st.columns(3)
+    with colf1:
+        filtro_alerta = st.multiselect(
+            "Filtrar por Alerta de custo",
+            options=["Alerta Vermelho", "Avaliar giro", "Sem urgência", "Sem custo"],
+            default=["Alerta Vermelho", "Avaliar giro", "Sem urgência", "Sem custo"],
+        )
+    with colf2:
+        filtro_acao = st.multiselect(
+            "Filtrar por Comentário estoque",
+            options=list(ACAO_PESO.keys()),
+            default=list(ACAO_PESO.keys()),
+        )
+    with colf3:
+        termo = st.text_input("Busca por SKU/Produto")
+
+    df_view = df_emp
+    if filtro_alerta:
+        df_view = df_view[df_view["Alerta de custo"].isin(filtro_alerta)]
+    if filtro_acao:
+        df_view = df_view[df_view["Comentário estoque"].isin(filtro_acao)]
+    if termo:
+        termo_l = termo.lower().strip()
+        df_view = df_view[
+            df_view["SKU"].str.lower().str.contains(termo_l, na=False)
+            | df_view["Produto"].str.lower().str.contains(termo_l, na=False)
+        ]
+
+    # Tabela com cor na coluna "Alerta de custo"
+    mostrar_tabela_alerta(df_view, "Alerta de custo", key="todos_empresa")
+
+
 # --------------------------
 # UI — Sidebar
 # --------------------------
@@ -458,6 +653,12 @@ with st.sidebar:
 
     if "empresas_data" not in st.session_state:
         st.session_state.empresas_data = {}
+    if "empresas_partial" not in st.session_state:
+        st.session_state.empresas_partial = {}
+    if "empresas_agg" not in st.session_state:
+        st.session_state.empresas_agg = {}
+    if "empresas_versao" not in st.session_state:
+        st.session_state.empresas_versao = {}
 
 st.title("📦 Análise Full — Dashboard")
 
@@ -470,18 +671,23 @@ if run:
     else:
         with st.spinner("Lendo e preparando dados…"):
             # 1) FULL
-            df_full = read_full_resumo(full_file)
+            full_bytes = full_file.getvalue()
+            df_full = _read_full_resumo_cached(full_bytes)
             df_emp = filtrar_e_sugerir(df_full)
+            # Versão da empresa = hash dos arquivos de entrada (chave dos caches da sessão)
+            versao = hashlib.sha1(full_bytes)
 
             # 2) Custos (opcional)
             if custos_file is not None:
-                df_custos = read_custos(custos_file)
+                custos_bytes = custos_file.getvalue()
+                versao.update(b"\0custos\0" + custos_bytes)
+                df_custos = _read_custos_cached(custos_bytes)
                 df_emp = aplicar_custos(df_emp, df_custos)
             else:
                 # Preencher colunas de custo vazias p/ manter o layout
                 for c in ["Estoque antigo", "Dias estocado (média)", "Custo total", "Aptas custo", "Alerta de custo"]:
                     if c not in df_emp.columns:
-                        df_emp[c] = 0 if c != "Alerta de custo" else "Sem custo"
+                        df_emp[c] = 0 if c != "Alerta de custo" else pd.Series("Sem custo", index=df_emp.index, dtype=ALERTA_DTYPE)
 
             # Reordena e renomeia colunas para espelhar a macro
             cols_order = [
@@ -495,6 +701,9 @@ if run:
 
             # Salva na sessão
             st.session_state.empresas_data[empresa] = df_emp.copy()
+            st.session_state.empresas_partial[empresa] = parcial_empresa(df_emp)
+            st.session_state.empresas_agg[empresa] = agregados_empresa(df_emp)
+            st.session_state.empresas_versao[empresa] = versao.hexdigest()
 
         st.success(f"Processado para {empresa} — {len(df_emp):,} SKUs")
 
@@ -510,23 +719,23 @@ with aba[0]:
     if df_emp is None or df_emp.empty:
         st.info("Envie e processe os arquivos para esta empresa na barra lateral.")
     else:
-        # KPIs
+        # KPIs (totais pré-calculados ao processar a empresa)
+        kpi = st.session_state.empresas_agg.get(empresa) or agregados_empresa(df_emp)
         c1, c2, c3, c4, c5 = st.columns(5)
         with c1:
             st.markdown('<div class="kpi-card"><div class="section-title">SKUs</div>'
-                        f'<h3>{human_int(len(df_emp))}</h3></div>', unsafe_allow_html=True)
+                        f'<h3>{human_int(kpi["skus"])}</h3></div>', unsafe_allow_html=True)
         with c2:
             st.markdown('<div class="kpi-card"><div class="section-title">Vendas 30d</div>'
-                        f'<h3>{human_int(df_emp["Vendas últimos 30 dias"].sum())}</h3></div>', unsafe_allow_html=True)
+                        f'<h3>{human_int(kpi["vendas30"])}</h3></div>', unsafe_allow_html=True)
         with c3:
             st.markdown('<div class="kpi-card"><div class="section-title">Estoque Full</div>'
-                        f'<h3>{human_int(df_emp["Estoque Full"].sum())}</h3></div>', unsafe_allow_html=True)
+                        f'<h3>{human_int(kpi["estoque"])}</h3></div>', unsafe_allow_html=True)
         with c4:
-            total_custo = float(df_emp["Custo total"].fillna(0).sum())
             st.markdown('<div class="kpi-card"><div class="section-title">Custo Total</div>'
-                        f'<h3>R$ {total_custo:,.2f}</h3></div>'.replace(",", "X").replace(".", ",").replace("X", "."), unsafe_allow_html=True)
+                        f'<h3>{human_brl(kpi["custo"])}</h3></div>', unsafe_allow_html=True)
         with c5:
-            alertas = df_emp["Alerta de custo"].value_counts().to_dict()
+            alertas = kpi["alertas"]
             a_red = alertas.get("Alerta Vermelho", 0)
             a_yel = alertas.get("Avaliar giro", 0)
             a_grn = alertas.get("Sem urgência", 0)
@@ -543,41 +752,8 @@ with aba[0]:
 
         st.divider()
 
-        # Filtros básicos
-        colf1, colf2, colf3 = st.columns(3)
-        with colf1:
-            filtro_alerta = st.multiselect(
-                "Filtrar por Alerta de custo",
-                options=["Alerta Vermelho", "Avaliar giro", "Sem urgência", "Sem custo"],
-                default=["Alerta Vermelho", "Avaliar giro", "Sem urgência", "Sem custo"],
-            )
-        with colf2:
-            filtro_acao = st.multiselect(
-                "Filtrar por Comentário estoque",
-                options=list(ACAO_PESO.keys()),
-                default=list(ACAO_PESO.keys()),
-            )
-        with colf3:
-            termo = st.text_input("Busca por SKU/Produto")
-
-        df_view = df_emp.copy()
-        if filtro_alerta:
-            df_view = df_view[df_view["Alerta de custo"].isin(filtro_alerta)]
-        if filtro_acao:
-            df_view = df_view[df_view["Comentário estoque"].isin(filtro_acao)]
-        if termo:
-            termo_l = termo.lower().strip()
-            df_view = df_view[
-                df_view["SKU"].str.lower().str.contains(termo_l, na=False)
-                | df_view["Produto"].str.lower().str.contains(termo_l, na=False)
-            ]
-
-        # Estilo para a coluna "Alerta de custo"
-        def styler(sdf: pd.DataFrame):
-            sty = sdf.style.applymap(color_alert, subset=["Alerta de custo"])  # cores
-            return sty
-
-        st.dataframe(styler(df_view), use_container_width=True, hide_index=True)
+        # Filtros + tabela (fragmento: mudar um filtro só reexecuta este trecho)
+        _render_filtros_empresa(df_emp)
 
 # --- 2) Consolidado
 with aba[1]:
@@ -586,7 +762,7 @@ with aba[1]:
     if not dados:
         st.info("Carregue pelo menos uma empresa na aba anterior.")
     else:
-        df_con = consolidar_empresas(dados)
+        df_con = consolidado_da_sessao()
         if df_con.empty:
             st.info("Sem dados consolidados.")
         else:
@@ -603,12 +779,12 @@ with aba[1]:
                             f'<h3>{human_int(df_con["Total Estoque"].sum())}</h3></div>', unsafe_allow_html=True)
             with c4:
                 st.markdown('<div class="kpi-card"><div class="section-title">Custo Total</div>'
-                            f'<h3>R$ {df_con["Custo Total"].sum():,.2f}</h3></div>'.replace(",", "X").replace(".", ",").replace("X", "."), unsafe_allow_html=True)
+                            f'<h3>{human_brl(df_con["Custo Total"].sum())}</h3></div>', unsafe_allow_html=True)
 
             st.divider()
 
             # Tabela com cor de Alerta
-            st.dataframe(df_con.style.applymap(color_alert, subset=["Alerta de Custo"]), use_container_width=True, hide_index=True)
+            mostrar_tabela_alerta(df_con, "Alerta de Custo", key="todos_consolidado")
 
 # --- 3) Reposição
 with aba[2]:
@@ -617,11 +793,11 @@ with aba[2]:
     if not dados:
         st.info("Carregue pelo menos uma empresa na aba 'Empresa'.")
     else:
-        df_con = consolidar_empresas(dados)
+        df_con = consolidado_da_sessao()
         if df_con.empty:
             st.info("Sem dados consolidados.")
         else:
-            df_rep = simular_reposicao(df_con)
+            df_rep = reposicao_da_sessao(df_con)
             # Ordenar por criticidade
             ord_map = {"Ruptura total": 0, "Reposição urgente": 1, "Reposição recomendada": 2, "OK": 3}
             df_rep["_ord"] = df_rep["Criticidade"].map(ord_map)
@@ -639,10 +815,10 @@ with aba[3]:
         for emp, dfe in st.session_state.empresas_data.items():
             dfs_xlsx[f"{emp}"] = dfe
         # Consolidado geral
-        df_con = consolidar_empresas(st.session_state.empresas_data)
+        df_con = consolidado_da_sessao()
         if not df_con.empty:
             dfs_xlsx["Painel Consolidado"] = df_con
-            df_rep = simular_reposicao(df_con)
+            df_rep = reposicao_da_sessao(df_con)
             if not df_rep.empty:
                 dfs_xlsx["Reposição Full"] = df_rep
 